@@ -6,10 +6,16 @@ from dotenv import load_dotenv
 from pathlib import Path
 import os
 from datetime import datetime
-from openai import OpenAI
 import re
 import random
 import json
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import deque, OrderedDict
+
+from shared_state import SharedState
 
 
 ENV_PATH = Path(__file__).resolve().parent / ".env"
@@ -23,15 +29,72 @@ AI_ENABLED = os.getenv("AI_ENABLED", "0") == "1"
 AI_DRY_RUN = os.getenv("AI_DRY_RUN", "0") == "1"
 AI_TEST_NO_CACHE = os.getenv("AI_TEST_NO_CACHE", "0") == "1"
 AI_TEST_MAX_CALLS_PER_USER = int(os.getenv("AI_TEST_MAX_CALLS_PER_USER", "1"))
+AI_SHADOW = os.getenv("AI_SHADOW", "0") == "1"
+AI_SHADOW_SAMPLE_RATE = float(os.getenv("AI_SHADOW_SAMPLE_RATE", "0.1"))
+AI_SHADOW_CONCURRENCY = int(os.getenv("AI_SHADOW_CONCURRENCY", "2"))
+AI_SHADOW_QUEUE_SIZE = int(os.getenv("AI_SHADOW_QUEUE_SIZE", "100"))
+AI_SHADOW_MAX_CALLS_PER_DAY = int(os.getenv("AI_SHADOW_MAX_CALLS_PER_DAY", "500"))
+AI_SHADOW_FLUSH_EVERY = int(os.getenv("AI_SHADOW_FLUSH_EVERY", "50"))
+AI_SHADOW_DRAIN_SECONDS = float(os.getenv("AI_SHADOW_DRAIN_SECONDS", "10"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", str(Path(__file__).resolve().parent / "profiles")))
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+STATE_DIR = Path(os.getenv("STATE_DIR", str(Path(__file__).resolve().parent / "state")))
+STATE_DB = os.getenv("STATE_DB", ":memory:")
+# дневной расход AI всегда на диске: рестарт не должен обнулять потолок
+AI_SPEND_DB = os.getenv(
+    "AI_SPEND_DB",
+    STATE_DB if STATE_DB != ":memory:" else str(STATE_DIR / "state.db"),
+)
+STATE_BUSY_TIMEOUT = float(os.getenv("STATE_BUSY_TIMEOUT", "0.25"))
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "86400"))
+STATE_COUNTER_TTL = float(os.getenv("STATE_COUNTER_TTL", str(2 * 86400)))
+TENANTS_CONFIG = os.getenv("TENANTS_CONFIG")
+TENANT_CACHE_SIZE = int(os.getenv("TENANT_CACHE_SIZE", "32"))
+TENANT_IDLE_SECONDS = float(os.getenv("TENANT_IDLE_SECONDS", "3600"))
+TENANT_SNAPSHOT_MAX_AGE = float(os.getenv("TENANT_SNAPSHOT_MAX_AGE", "600"))
+
+# счетчики с дневным ключом и бакеты: их чистим по STATE_COUNTER_TTL.
+# ai_test_calls (лимит на юзера за время работы) по TTL не трогаем
+STATE_PRUNE_COUNTERS = ("ai_bucket", "shadow_calls", "ai_spend_usd")
+# переживают reset() общего стора на старте BOT_WORKERS > 1
+STATE_KEEP_ON_RESET = ("ai_spend_usd",)
+
+
+# счетчики и кеши (тестовый лимит AI на юзера, UNKNOWN-кеш, лимиты AI) живут здесь;
+# в режиме BOT_WORKERS > 1 воркеры открывают общий файл в STATE_DIR
+def open_state(path=STATE_DB) -> SharedState:
+    return SharedState(
+        path,
+        busy_timeout=STATE_BUSY_TIMEOUT,
+        cache_ttl=STATE_CACHE_TTL,
+        counter_ttl=STATE_COUNTER_TTL,
+        prune_counters=STATE_PRUNE_COUNTERS,
+    )
+
+
+STATE = open_state()
 
-AI_TEST_CALLS = {}  # user_id -> int
+
+async def state_call(method: str, *args, default=None):
+    # SQLite не трогаем из event loop: в потоке, а если база занята
+    # другим воркером дольше STATE_BUSY_TIMEOUT - отдаем default
+    try:
+        return await asyncio.to_thread(getattr(STATE, method), *args)
+    except sqlite3.OperationalError as e:
+        print(f"State {method} failed: {e}")
+        return default
 
 def ai_mode() -> str:
     # "off" - AI не вызываем
     # "dry_run" - AI вызываем, но пользователю не показываем результат (только лог)
+    # "shadow" - пользователю отвечаем правилами, AI в фоне на выборке
     # "live" - AI вызываем и используем результат
     if not AI_ENABLED:
         return "off"
+    if AI_SHADOW:
+        return "shadow"
     if AI_DRY_RUN:
         return "dry_run"
     return "live"
@@ -44,31 +107,27 @@ print("GOOGLE_SERVICE_ACCOUNT_JSON =", "SET" if GOOGLE_SERVICE_ACCOUNT_JSON else
 print("ROUTER_DEBUG =", ROUTER_DEBUG)
 print("AI_ENABLED =", AI_ENABLED)
 print("AI_DRY_RUN =", AI_DRY_RUN)
+print("AI_SHADOW =", AI_SHADOW, f"(sample={AI_SHADOW_SAMPLE_RATE})" if AI_SHADOW else "")
 print("-" * 50)
 
 
-# ==================================================
-# TELEGRAM IMPORTS
-# ==================================================
-
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    filters,
-)
-
 # ==================================================
 # GOOGLE SHEETS CLIENT
+# Тяжелые импорты и клиент создаются лениво, при первом обращении,
+# чтобы import main не ходил в сеть и не грузил googleapiclient.
 # ==================================================
 
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+SHEETS = None
+SHEETS_READY = False
+
 
 def get_sheets_client():
-    if not GOOGLE_SHEET_ID or not GOOGLE_SERVICE_ACCOUNT_JSON:
+    if not GOOGLE_SERVICE_ACCOUNT_JSON or not (GOOGLE_SHEET_ID or TENANTS_CONFIG):
         return None
 
+    from google.oauth2.service_account import Credentials
+    from googleapiclient.discovery import build
+
     try:
         info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
     except Exception as e:
@@ -83,26 +142,32 @@ def get_sheets_client():
     service = build("sheets", "v4", credentials=creds)
     return service.spreadsheets()
 
-SHEETS = get_sheets_client()
+def get_sheets():
+    global SHEETS, SHEETS_READY
+    if not SHEETS_READY:
+        SHEETS = get_sheets_client()
+        SHEETS_READY = True
+    return SHEETS
 
 # ==================================================
 # LOAD CONTEXTS (ROUTER KEYWORDS)
 # ==================================================
 
-def load_router_keywords():
+def load_router_keywords(rows=None):
     keywords = {}
 
-    if not SHEETS:
+    sheets = get_sheets() if rows is None else None
+    if rows is None and not sheets:
         print("Sheets client not available, router disabled")
         return keywords
 
     try:
-        result = SHEETS.values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range="contexts!A:B",
-        ).execute()
-
-        rows = result.get("values", [])
+        if rows is None:
+            result = sheets.values().get(
+                spreadsheetId=GOOGLE_SHEET_ID,
+                range="contexts!A:B",
+            ).execute()
+            rows = result.get("values", [])
 
         for row in rows[1:]:
             if len(row) < 2:
@@ -127,20 +192,21 @@ def load_router_keywords():
 # LOAD RESPONSES
 # ==================================================
 
-def load_responses():
+def load_responses(rows=None):
     responses = {}
 
-    if not SHEETS:
+    sheets = get_sheets() if rows is None else None
+    if rows is None and not sheets:
         print("Sheets client not available, responses disabled")
         return responses
 
     try:
-        result = SHEETS.values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
-            range="responses!A:B",
-        ).execute()
-
-        rows = result.get("values", [])
+        if rows is None:
+            result = sheets.values().get(
+                spreadsheetId=GOOGLE_SHEET_ID,
+                range="responses!A:B",
+            ).execute()
+            rows = result.get("values", [])
 
         for row in rows[1:]:
             if len(row) < 2:
@@ -165,8 +231,10 @@ def load_responses():
 # USER LOGGING
 # ==================================================
 
-def log_user(update):
-    if not SHEETS:
+def log_user(update, tenant=None):
+    sheets = get_sheets()
+    sheet_id = (tenant or default_tenant())["sheet_id"]
+    if not sheets or not sheet_id:
         return
 
     user = update.effective_user
@@ -179,8 +247,8 @@ def log_user(update):
     now = datetime.utcnow().isoformat(timespec="seconds")
 
     try:
-        result = SHEETS.values().get(
-            spreadsheetId=GOOGLE_SHEET_ID,
+        result = sheets.values().get(
+            spreadsheetId=sheet_id,
             range="users!A:A",
         ).execute()
 
@@ -189,15 +257,15 @@ def log_user(update):
 
         if telegram_id in ids:
             row_index = ids.index(telegram_id) + 2
-            SHEETS.values().update(
-                spreadsheetId=GOOGLE_SHEET_ID,
+            sheets.values().update(
+                spreadsheetId=sheet_id,
                 range=f"users!E{row_index}",
                 valueInputOption="RAW",
                 body={"values": [[now]]},
             ).execute()
         else:
-            SHEETS.values().append(
-                spreadsheetId=GOOGLE_SHEET_ID,
+            sheets.values().append(
+                spreadsheetId=sheet_id,
                 range="users!A:E",
                 valueInputOption="RAW",
                 body={
@@ -219,8 +287,10 @@ def log_user(update):
 # MESSAGE LOGGING
 # ==================================================
 
-def log_message(update, project: str):
-    if not SHEETS:
+def log_message(update, project: str, tenant=None):
+    sheets = get_sheets()
+    sheet_id = (tenant or default_tenant())["sheet_id"]
+    if not sheets or not sheet_id:
         return
 
     user = update.effective_user
@@ -235,8 +305,8 @@ def log_message(update, project: str):
     timestamp = datetime.utcnow().isoformat(timespec="seconds")
 
     try:
-        SHEETS.values().append(
-            spreadsheetId=GOOGLE_SHEET_ID,
+        sheets.values().append(
+            spreadsheetId=sheet_id,
             range="messages!A:E",
             valueInputOption="RAW",
             body={
@@ -254,17 +324,67 @@ def log_message(update, project: str):
         print(f"Message log failed: {e}")
 
 # ==================================================
-# UNKNOWN CACHE (ANTI-AI SPAM)
+# INIT DATA
 # ==================================================
 
-UNKNOWN_CACHE = set()
+# заполняются в init_data() на старте приложения, не при импорте
+ROUTER_KEYWORDS = {}
+RESPONSES = {}
+
+
+def value_ranges(result, count: int):
+    # values из batchGet; короткий или странный ответ добиваем пустыми
+    ranges = (result or {}).get("valueRanges") or []
+    values = [(r or {}).get("values", []) for r in ranges[:count]]
+    return values + [[] for _ in range(count - len(values))]
 
-# ==================================================
-# INIT DATA
-# ==================================================
 
-ROUTER_KEYWORDS = load_router_keywords()
-RESPONSES = load_responses()
+def init_data():
+    # contexts + responses одним batchGet вместо двух запросов
+    global ROUTER_KEYWORDS, RESPONSES
+
+    sheets = get_sheets()
+    if not sheets:
+        ROUTER_KEYWORDS = load_router_keywords()
+        RESPONSES = load_responses()
+        return
+
+    if not GOOGLE_SHEET_ID:
+        # только тенанты из TENANTS_CONFIG, дефолтной таблицы нет
+        return
+
+    try:
+        result = sheets.values().batchGet(
+            spreadsheetId=GOOGLE_SHEET_ID,
+            ranges=["contexts!A:B", "responses!A:B"],
+        ).execute()
+        contexts, responses = value_ranges(result, 2)
+
+    except Exception as e:
+        print(f"Failed to load sheet data: {e}")
+        return
+
+    ROUTER_KEYWORDS = load_router_keywords(contexts)
+    RESPONSES = load_responses(responses)
+
+
+def save_routing_snapshot(path: Path):
+    # read-only снапшот для воркеров: Sheets грузит только front-процесс
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"router_keywords": ROUTER_KEYWORDS, "responses": RESPONSES}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def load_routing_snapshot(path: Path):
+    global ROUTER_KEYWORDS, RESPONSES
+
+    with open(path, encoding="utf-8") as f:
+        snapshot = json.load(f)
+
+    ROUTER_KEYWORDS = snapshot.get("router_keywords", {})
+    RESPONSES = snapshot.get("responses", {})
 
 # ==================================================
 # PRE_INTENTS
@@ -362,16 +482,17 @@ def is_dont_understand(text: str) -> bool:
 # ROUTER
 # ==================================================
 
-def score_projects(text: str):
+def score_projects(text: str, tenant=None):
     scores = {}
     matches = {}
 
-    if not text or not ROUTER_KEYWORDS:
+    router_keywords = (tenant or default_tenant())["router_keywords"]
+    if not text or not router_keywords:
         return scores, matches
 
     text_l = text.lower()
 
-    for project, keywords in ROUTER_KEYWORDS.items():
+    for project, keywords in router_keywords.items():
         score = 0
         hit = []
 
@@ -385,8 +506,8 @@ def score_projects(text: str):
 
     return scores, matches
 
-def detect_project(text: str) -> str:
-    scores, _ = score_projects(text)
+def detect_project(text: str, tenant=None) -> str:
+    scores, _ = score_projects(text, tenant)
 
     if not scores:
         return "UNKNOWN"
@@ -408,8 +529,8 @@ def detect_project(text: str) -> str:
 # RESPONSE RESOLVER
 # ==================================================
 
-def get_response(key: str, fallback: str = "…") -> str:
-    variants = RESPONSES.get(key)
+def get_response(key: str, fallback: str = "…", tenant=None) -> str:
+    variants = (tenant or default_tenant())["responses"].get(key)
     if not variants:
         print(f"[WARN] Missing response for key: {key}")
         return fallback
@@ -555,28 +676,292 @@ INTENT_PATTERNS = [
 ]
 
 
-def detect_intent(text: str) -> str | None:
-    t = normalize_text(text)
-    if not t:
-        return None
-
-    # 👇 КРИТИЧНО: одиночные сообщения
-    for key, patterns in INTENT_PATTERNS:
-        if t in patterns:
-            return key
+def compile_intents(intent_patterns):
+    # один раз на тенанта: паттерны нормализуются заранее, а не на каждое сообщение
+    exact = {}
+    scan = []
 
-    for key, patterns in INTENT_PATTERNS:
+    for key, patterns in intent_patterns:
         for p in patterns:
+            # первый ключ в порядке INTENT_PATTERNS выигрывает
+            exact.setdefault(p, key)
+
             p = normalize_text(p)
             if not p:
                 continue
+            scan.append((key, p, p[:-1] if len(p) >= 4 else None))
 
-            # точное или частичное совпадение по корню
-            if p in t or (len(p) >= 4 and p[:-1] in t):
-                return key
+    return exact, scan
+
+
+def match_intent(text: str, tenant=None) -> tuple[str | None, int]:
+    # -> (key, сколько проверок сделано); число проверок смотрит routing_eval
+    t = normalize_text(text)
+    if not t:
+        return None, 0
+
+    index = tenant or default_tenant()
+
+    # 👇 КРИТИЧНО: одиночные сообщения
+    key = index["intent_exact"].get(t)
+    if key:
+        return key, 1
+
+    probes = 1
+    for key, p, stem in index["intent_scan"]:
+        probes += 1
+        # точное или частичное совпадение по корню
+        if p in t or (stem and stem in t):
+            return key, probes
+
+    return None, probes
+
+
+def detect_intent(text: str, tenant=None) -> str | None:
+    return match_intent(text, tenant)[0]
 
-    return None
 
+# ==================================================
+# TENANTS (MULTI-BOT ROUTING TABLES)
+# Каждый тенант (продуктовый бот) - свой индекс: contexts, responses,
+# интенты. Индексы лежат в LRU, неактивные выгружаются и потом
+# поднимаются из локального снапшота STATE_DIR/tenants/<id>.json.
+# Стоимость роутинга сообщения не зависит от числа тенантов.
+# ==================================================
+
+TENANTS = {}  # tenant_id -> config из TENANTS_CONFIG
+TENANT_INDEXES = OrderedDict()  # tenant_id -> index (LRU)
+TENANT_LOADS = {}  # tenant_id -> asyncio.Task холодной загрузки
+TENANT_REFRESHES = {}  # tenant_id -> asyncio.Task фонового обновления
+DEFAULT_TENANT = {"index": None}
+
+
+def compile_tenant(tenant_id: str, router_keywords, responses, intent_patterns, config=None, loaded_at=None):
+    config = config or {}
+    intent_exact, intent_scan = compile_intents(intent_patterns)
+
+    return {
+        "id": tenant_id,
+        "sheet_id": config.get("sheet_id", GOOGLE_SHEET_ID),
+        # для промпта AI: "поддержки <product_genitive>", "не про <topic>"
+        "product_genitive": config.get("product_genitive", "тренажера ПДД"),
+        "topic": config.get("topic", "ПДД или тренажер"),
+        "router_keywords": router_keywords,
+        "responses": responses,
+        "intent_exact": intent_exact,
+        "intent_scan": intent_scan,
+        "used": time.monotonic(),
+        "loaded_at": loaded_at or time.time(),
+    }
+
+
+def default_tenant():
+    # индекс из глобальных ROUTER_KEYWORDS / RESPONSES / INTENT_PATTERNS;
+    # пересобираем, только если их переприсвоили (init_data, снапшот)
+    sources = (ROUTER_KEYWORDS, RESPONSES, INTENT_PATTERNS)
+    cached = DEFAULT_TENANT["index"]
+    if cached is None or any(a is not b for a, b in zip(DEFAULT_TENANT["sources"], sources)):
+        DEFAULT_TENANT["index"] = compile_tenant("default", *sources)
+        DEFAULT_TENANT["sources"] = sources
+    return DEFAULT_TENANT["index"]
+
+
+def load_tenants_config():
+    global TENANTS
+
+    if not TENANTS_CONFIG:
+        return
+
+    try:
+        with open(TENANTS_CONFIG, encoding="utf-8") as f:
+            TENANTS = json.load(f)
+        print(f"Loaded tenants: {list(TENANTS.keys())}")
+    except Exception as e:
+        print(f"Failed to load TENANTS_CONFIG: {e}")
+
+
+def tenant_snapshot_path(tenant_id: str) -> Path:
+    return STATE_DIR / "tenants" / f"{tenant_id}.json"
+
+
+def fetch_tenant_intents(sheets, sheet_id: str):
+    # отдельным запросом: если вкладки intents нет, Sheets отклонит
+    # весь batchGet (400), а contexts/responses терять нельзя
+    try:
+        result = sheets.values().get(spreadsheetId=sheet_id, range="intents!A:B").execute()
+        return (result or {}).get("values", [])
+    except Exception as e:
+        print(f"Failed to load intents for tenant sheet {sheet_id}: {e}")
+        return []
+
+
+def fetch_tenant_data(config):
+    # contexts + responses одним batchGet, intents (key, pattern) - только
+    # если тенант не на встроенных INTENT_PATTERNS
+    sheets = get_sheets()
+    if not sheets or not config.get("sheet_id"):
+        return None
+
+    try:
+        result = sheets.values().batchGet(
+            spreadsheetId=config["sheet_id"],
+            ranges=["contexts!A:B", "responses!A:B"],
+        ).execute()
+        contexts, responses = value_ranges(result, 2)
+
+    except Exception as e:
+        print(f"Failed to load tenant sheet {config.get('sheet_id')}: {e}")
+        return None
+
+    intents = []
+    if not config.get("use_builtin_intents"):
+        intents = fetch_tenant_intents(sheets, config["sheet_id"])
+
+    intent_patterns = {}
+    for row in intents[1:]:
+        if len(row) < 2 or not row[0].strip() or not row[1].strip():
+            continue
+        intent_patterns.setdefault(row[0].strip(), []).append(row[1].strip().lower())
+
+    return {
+        "router_keywords": load_router_keywords(contexts),
+        "responses": load_responses(responses),
+        "intent_patterns": list(intent_patterns.items()),
+    }
+
+
+def save_tenant_snapshot(tenant_id: str, data):
+    path = tenant_snapshot_path(tenant_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def load_tenant_data(tenant_id: str, config):
+    # -> (data, loaded_at). Снапшот есть - берем его, даже старый
+    # (обновится в фоне); в Sheets идем, только если снапшота нет совсем.
+    # Блокирующая функция: звать через asyncio.to_thread
+    path = tenant_snapshot_path(tenant_id)
+    if path.exists():
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f), path.stat().st_mtime
+        except Exception as e:
+            print(f"Broken tenant snapshot {path}: {e}")
+
+    data = fetch_tenant_data(config)
+    if data is None:
+        return {"router_keywords": {}, "responses": {}, "intent_patterns": []}, 0.0
+
+    try:
+        save_tenant_snapshot(tenant_id, data)
+    except Exception as e:
+        print(f"Tenant snapshot save failed: {e}")
+    return data, time.time()
+
+
+def build_tenant_index(tenant_id: str, data, loaded_at: float):
+    config = TENANTS[tenant_id]
+
+    intent_patterns = data.get("intent_patterns") or []
+    if config.get("use_builtin_intents"):
+        intent_patterns = INTENT_PATTERNS
+
+    return compile_tenant(
+        tenant_id,
+        data.get("router_keywords", {}),
+        data.get("responses", {}),
+        intent_patterns,
+        config,
+        loaded_at,
+    )
+
+
+async def load_tenant(tenant_id: str):
+    data, loaded_at = await asyncio.to_thread(load_tenant_data, tenant_id, TENANTS[tenant_id])
+    index = build_tenant_index(tenant_id, data, loaded_at)
+    TENANT_INDEXES[tenant_id] = index
+    return index
+
+
+async def refresh_tenant(tenant_id: str):
+    # фоновое обновление из Sheets: индекс подменяем, только если
+    # тенант еще в памяти; при ошибке остаемся на старом снапшоте
+    data = await asyncio.to_thread(fetch_tenant_data, TENANTS[tenant_id])
+    if data is None:
+        index = TENANT_INDEXES.get(tenant_id)
+        if index:
+            index["loaded_at"] = time.time()  # не долбим Sheets на каждом сообщении
+        return
+
+    await asyncio.to_thread(save_tenant_snapshot, tenant_id, data)
+    if tenant_id in TENANT_INDEXES:
+        index = build_tenant_index(tenant_id, data, time.time())
+        index["used"] = TENANT_INDEXES[tenant_id]["used"]
+        TENANT_INDEXES[tenant_id] = index
+
+
+def run_tenant_task(tasks: dict, tenant_id: str, coro):
+    # одна задача на тенанта в tasks (TENANT_LOADS / TENANT_REFRESHES);
+    # параллельные сообщения ждут уже запущенную
+    task = tasks.get(tenant_id)
+    if task is None:
+        task = asyncio.create_task(coro)
+        tasks[tenant_id] = task
+        task.add_done_callback(lambda _: tasks.pop(tenant_id, None))
+    else:
+        coro.close()
+    return task
+
+
+def evict_tenants():
+    now = time.monotonic()
+
+    while len(TENANT_INDEXES) > TENANT_CACHE_SIZE:
+        tenant_id, _ = TENANT_INDEXES.popitem(last=False)
+        if ROUTER_DEBUG:
+            print("TENANT EVICTED (LRU):", tenant_id)
+
+    # самый давний в начале, дальше можно не смотреть
+    while TENANT_INDEXES:
+        tenant_id, index = next(iter(TENANT_INDEXES.items()))
+        if now - index["used"] < TENANT_IDLE_SECONDS:
+            break
+        TENANT_INDEXES.popitem(last=False)
+        if ROUTER_DEBUG:
+            print("TENANT EVICTED (IDLE):", tenant_id)
+
+
+async def get_tenant(tenant_id: str | None = None):
+    # event loop не блокируем: холодный тенант грузится в потоке,
+    # устаревший отдается сразу и обновляется в фоне
+    if not tenant_id or tenant_id not in TENANTS:
+        return default_tenant()
+
+    index = TENANT_INDEXES.get(tenant_id)
+    if index is None:
+        # ждем только загрузку (не фоновое обновление - оно ничего не отдает)
+        index = await run_tenant_task(TENANT_LOADS, tenant_id, load_tenant(tenant_id))
+        if index is None:
+            index = await load_tenant(tenant_id)
+        # пока ждали, тенанта могли вытеснить из LRU другие сообщения
+        index = TENANT_INDEXES.setdefault(tenant_id, index)
+    TENANT_INDEXES.move_to_end(tenant_id)
+
+    if time.time() - index["loaded_at"] >= TENANT_SNAPSHOT_MAX_AGE:
+        run_tenant_task(TENANT_REFRESHES, tenant_id, refresh_tenant(tenant_id))
+
+    index["used"] = time.monotonic()
+    evict_tenants()
+    return index
+
+
+async def tenant_for(context):
+    # tenant_id кладется в bot_data при сборке Application для бота
+    bot_data = getattr(context, "bot_data", None) or {}
+    return await get_tenant(bot_data.get("tenant_id"))
 
 
 # ==================================================
@@ -586,12 +971,127 @@ def detect_intent(text: str) -> str | None:
 # AFTER all filters and cache checks
 # ==================================================
 
-def ai_detect_intent(text: str) -> str | None:
+AI_MODEL = os.getenv("AI_MODEL", "gpt-4.1-mini")
+AI_MAX_INPUT_CHARS = int(os.getenv("AI_MAX_INPUT_CHARS", "300"))
+AI_MAX_OUTPUT_TOKENS = int(os.getenv("AI_MAX_OUTPUT_TOKENS", "16"))  # 16 - минимум у API
+
+AI_NOT_PDD = "NOT_PDD"
+
+OPENAI_CLIENT = None
+AI_PROMPT_CACHE = {}  # tenant_id -> {"keys", "instructions", "format"}
+AI_STATS = {"calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "latency_ms": 0.0}
+
+
+def get_openai_client(api_key: str):
+    global OPENAI_CLIENT
+    if OPENAI_CLIENT is None:
+        from openai import OpenAI
+
+        OPENAI_CLIENT = OpenAI(api_key=api_key)
+    return OPENAI_CLIENT
+
+
+def ai_intent_keys(tenant) -> list[str]:
+    # только ключи интентов: в responses есть и служебные (PDD_ACK,
+    # <PROJECT>_ACK), их AI выбирать не должен. Если responses загружены,
+    # оставляем интенты, у которых есть ответ
+    keys = set(tenant["intent_exact"].values()) | {key for key, _, _ in tenant["intent_scan"]}
+    if tenant["responses"]:
+        keys &= set(tenant["responses"].keys())
+    keys.add("UNKNOWN")
+    return sorted(keys)
+
+
+def ai_prompt_prefix(tenant=None):
+    # статичный префикс: пересобираем только когда меняется набор ключей.
+    # ВАЖНО: prompt caching у OpenAI включается от 1024 токенов префикса,
+    # а этот ~100 токенов - сейчас cached всегда 0. Выигрыш здесь за счет
+    # короткого промпта; кеш заработает, если добавить в instructions
+    # большой фиксированный блок (few-shot примеры и т.п.)
+    tenant = tenant or default_tenant()
+    keys = ai_intent_keys(tenant)
+    cached = AI_PROMPT_CACHE.get(tenant["id"])
+    if cached and cached["keys"] == keys:
+        return cached["instructions"], cached["format"]
+
+    instructions = (
+        f"Ты классификатор интентов для поддержки {tenant['product_genitive']}.\n"
+        "Выбери один ключ для сообщения пользователя.\n"
+        f"Если сообщение не про {tenant['topic']}, выбери {AI_NOT_PDD}.\n"
+        f"Если сообщение про {tenant['topic']}, но ни один ключ не подходит, выбери UNKNOWN."
+    )
+
+    # список ключей живет только в enum схемы ответа, в тексте не дублируем
+    text_format = {
+        "format": {
+            "type": "json_schema",
+            "name": "intent",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "key": {"type": "string", "enum": keys + [AI_NOT_PDD]},
+                },
+                "required": ["key"],
+                "additionalProperties": False,
+            },
+        }
+    }
+
+    AI_PROMPT_CACHE[tenant["id"]] = {"keys": keys, "instructions": instructions, "format": text_format}
+    return instructions, text_format
+
+
+def ai_record_usage(resp, latency_ms: float):
+    usage = getattr(resp, "usage", None)
+    input_tokens = getattr(usage, "input_tokens", 0) or 0
+    output_tokens = getattr(usage, "output_tokens", 0) or 0
+    details = getattr(usage, "input_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", 0) or 0
+
+    AI_STATS["calls"] += 1
+    AI_STATS["input_tokens"] += input_tokens
+    AI_STATS["cached_tokens"] += cached_tokens
+    AI_STATS["output_tokens"] += output_tokens
+    AI_STATS["latency_ms"] += latency_ms
+    governor_add_spend(input_tokens, cached_tokens, output_tokens)
+
+    print(
+        "AI CALL:",
+        {
+            "in": input_tokens,
+            "cached": cached_tokens,
+            "out": output_tokens,
+            "ms": round(latency_ms, 1),
+        },
+    )
+
+
+def log_ai_stats():
+    # итог за время работы процесса, печатаем на остановке
+    calls = AI_STATS["calls"]
+    if not calls:
+        return
+
+    print(
+        "AI STATS:",
+        {
+            "calls": calls,
+            "in": AI_STATS["input_tokens"],
+            "cached": AI_STATS["cached_tokens"],
+            "out": AI_STATS["output_tokens"],
+            "cached_share": round(AI_STATS["cached_tokens"] / max(1, AI_STATS["input_tokens"]), 3),
+            "avg_ms": round(AI_STATS["latency_ms"] / calls, 1),
+        },
+    )
+
+
+def ai_detect_intent(text: str, tenant=None) -> str | None:
     if not AI_ENABLED:
         return None
 
     # DRY RUN: проверяем, что дошли до ИИ
-    if AI_DRY_RUN:
+    if ai_mode() == "dry_run":
         print("AI DRY RUN")
         print("AI would be called with text:")
         print(repr(text))
@@ -605,47 +1105,26 @@ def ai_detect_intent(text: str) -> str | None:
         return None
 
     try:
-        client = OpenAI(api_key=api_key)
-
-        available_keys = [
-            "GREETING",
-            "WHAT_IS_PDD",
-            "WHAT_INSIDE",
-            "HOW_START",
-            "HOW_TO_LEARN",
-            "FREE_AVAILABLE",
-            "WHAT_IS_DRILL",
-            "WHAT_IS_EXAM",
-            "HOW_EXAM_WORKS",
-            "LANGUAGE_QUESTION",
-            "PRICE_INFO",
-            "PAYMENT_INFO",
-            "CONTACT_DEV",
-            "COMMANDS_IN_TRAINER_ONLY",
-            "CAN_CHOOSE_QUESTIONS",
-            "UNKNOWN",
-        ]
-
-        prompt = (
-            "Ты классификатор интентов для поддержки тренажера ПДД.\n"
-            "Твоя задача: выбрать один ключ из списка.\n"
-            "Если сообщение не про ПДД или тренажер, верни not_pdd.\n\n"
-            f"Ключи: {', '.join(available_keys)}\n\n"
-            f"Сообщение пользователя: \"{text}\"\n\n"
-            "Ответь строго одним словом: ключ или not_pdd."
-        )
+        client = get_openai_client(api_key)
+        instructions, text_format = ai_prompt_prefix(tenant)
 
+        started = time.perf_counter()
         resp = client.responses.create(
-            model="gpt-4.1-mini",
-            input=prompt,
+            model=AI_MODEL,
+            instructions=instructions,
+            input=(text or "").strip()[:AI_MAX_INPUT_CHARS],
+            text=text_format,
+            max_output_tokens=AI_MAX_OUTPUT_TOKENS,
+            temperature=0,
+            # роль играет только при префиксе >= 1024 токенов (см. ai_prompt_prefix)
+            prompt_cache_key=f"intent-classifier:{(tenant or default_tenant())['id']}",
+            store=False,
         )
+        ai_record_usage(resp, (time.perf_counter() - started) * 1000)
 
-        answer = (resp.output_text or "").strip()
-
-        if not answer:
-            return None
+        answer = json.loads(resp.output_text or "{}").get("key")
 
-        if answer.lower().startswith("not_pdd"):
+        if not answer or answer == AI_NOT_PDD:
             return None
 
         return answer
@@ -655,69 +1134,370 @@ def ai_detect_intent(text: str) -> str | None:
         return None
 
 
+# ==================================================
+# AI GOVERNOR (ADMISSION CONTROL)
+# Стоит перед ai_detect_intent:
+# - token bucket на юзера и глобальный (вызовов в минуту)
+# - дневной потолок расходов в USD (на диске, AI_SPEND_DB, переживает рестарт)
+# - адаптивный лимит одновременных вызовов по p95 латентности
+# Отказ = сразу дешевый UNKNOWN, без AI.
+# ==================================================
+
+AI_USER_RATE_PER_MIN = float(os.getenv("AI_USER_RATE_PER_MIN", "2"))
+AI_USER_BURST = float(os.getenv("AI_USER_BURST", "3"))
+AI_GLOBAL_RATE_PER_MIN = float(os.getenv("AI_GLOBAL_RATE_PER_MIN", "30"))
+AI_GLOBAL_BURST = float(os.getenv("AI_GLOBAL_BURST", "10"))
+AI_DAILY_SPEND_LIMIT_USD = float(os.getenv("AI_DAILY_SPEND_LIMIT_USD", "1.0"))
+AI_PRICE_INPUT_PER_1M = float(os.getenv("AI_PRICE_INPUT_PER_1M", "0.40"))
+AI_PRICE_CACHED_PER_1M = float(os.getenv("AI_PRICE_CACHED_PER_1M", "0.10"))
+AI_PRICE_OUTPUT_PER_1M = float(os.getenv("AI_PRICE_OUTPUT_PER_1M", "1.60"))
+AI_MAX_IN_FLIGHT = int(os.getenv("AI_MAX_IN_FLIGHT", "4"))
+AI_LATENCY_TARGET_MS = float(os.getenv("AI_LATENCY_TARGET_MS", "3000"))
+AI_LATENCY_WINDOW = int(os.getenv("AI_LATENCY_WINDOW", "20"))
+
+AI_GOVERNOR = {
+    "limit": max(1, AI_MAX_IN_FLIGHT),
+    "in_flight": 0,
+    "latencies": deque(maxlen=max(1, AI_LATENCY_WINDOW)),
+}
+
+
+SPEND_STATE = None
+SPEND_STATE_LOCK = threading.Lock()
+
+
+def get_spend_state() -> SharedState:
+    # открываем лениво (import main не трогает диск); если STATE уже
+    # смотрит в тот же файл (воркеры BOT_WORKERS > 1) - берем его
+    global SPEND_STATE
+    with SPEND_STATE_LOCK:
+        if SPEND_STATE is None:
+            if STATE.path == str(AI_SPEND_DB):
+                SPEND_STATE = STATE
+            else:
+                Path(AI_SPEND_DB).parent.mkdir(parents=True, exist_ok=True)
+                SPEND_STATE = open_state(AI_SPEND_DB)
+        return SPEND_STATE
+
+
+async def governor_spend_today() -> float:
+    # база занята или недоступна - считаем, что бюджет исчерпан (fail closed)
+    day = datetime.utcnow().date().isoformat()
+    try:
+        return await asyncio.to_thread(lambda: get_spend_state().counter_get("ai_spend_usd", day))
+    except sqlite3.OperationalError as e:
+        print(f"Spend check failed: {e}")
+        return float("inf")
+
+
+def governor_add_spend(input_tokens: int, cached_tokens: int, output_tokens: int):
+    usd = (
+        (input_tokens - cached_tokens) * AI_PRICE_INPUT_PER_1M
+        + cached_tokens * AI_PRICE_CACHED_PER_1M
+        + output_tokens * AI_PRICE_OUTPUT_PER_1M
+    ) / 1_000_000
+    # вызывается из потока AI-запроса; ошибка учета не должна терять ответ AI
+    try:
+        get_spend_state().counter_add("ai_spend_usd", datetime.utcnow().date().isoformat(), usd)
+    except sqlite3.OperationalError as e:
+        print(f"Spend accounting failed: {e}")
+
+
+def p95(values) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(0.95 * len(values)))]
+
+
+async def ai_admit(user_id=None, counters=()) -> str | None:
+    # None - пропускаем, иначе причина отказа.
+    # Сначала лимит параллельности, потом дневной бюджет и одним махом
+    # токены бакетов + бюджеты вызывающего (counters): при любом отказе
+    # ничего не списано
+    if AI_GOVERNOR["in_flight"] >= AI_GOVERNOR["limit"]:
+        return "concurrency"
+
+    # место резервируем до await, чтобы параллельные корутины не проскочили
+    AI_GOVERNOR["in_flight"] += 1
+    reason = await ai_charge(user_id, counters)
+    if reason:
+        AI_GOVERNOR["in_flight"] -= 1
+    return reason
+
+
+async def ai_charge(user_id, counters) -> str | None:
+    if AI_DAILY_SPEND_LIMIT_USD > 0 and await governor_spend_today() >= AI_DAILY_SPEND_LIMIT_USD:
+        return "daily_spend"
+
+    # rate <= 0 - лимит выключен
+    buckets = []
+    if user_id is not None and AI_USER_RATE_PER_MIN > 0:
+        buckets.append(("ai_bucket", user_id, AI_USER_RATE_PER_MIN, AI_USER_BURST))
+    if AI_GLOBAL_RATE_PER_MIN > 0:
+        buckets.append(("ai_bucket", "global", AI_GLOBAL_RATE_PER_MIN, AI_GLOBAL_BURST))
+
+    if buckets or counters:
+        return await state_call("charge_all", buckets, counters, default="state_busy")
+
+    return None
+
+
+def ai_release(latency_ms: float):
+    AI_GOVERNOR["in_flight"] = max(0, AI_GOVERNOR["in_flight"] - 1)
+
+    window = AI_GOVERNOR["latencies"]
+    window.append(latency_ms)
+    if len(window) < window.maxlen:
+        return
+
+    # AIMD: медленно - режем лимит вдвое, быстро - +1 до потолка
+    latency_p95 = p95(window)
+    old_limit = AI_GOVERNOR["limit"]
+    if latency_p95 > AI_LATENCY_TARGET_MS:
+        AI_GOVERNOR["limit"] = max(1, old_limit // 2)
+    elif old_limit < AI_MAX_IN_FLIGHT:
+        AI_GOVERNOR["limit"] = old_limit + 1
+    window.clear()
+
+    if ROUTER_DEBUG and AI_GOVERNOR["limit"] != old_limit:
+        print("AI GOVERNOR LIMIT:", {"p95_ms": round(latency_p95, 1), "limit": AI_GOVERNOR["limit"]})
+
+
+async def governed_ai_detect_intent(text: str, user_id=None, tenant=None, counters=()) -> tuple[bool, str | None]:
+    # (admitted, ai_key); counters - бюджеты вызывающего, списываются
+    # только вместе с допуском. Блокирующий вызов уводим в поток,
+    # чтобы in_flight реально отражал параллельные запросы
+    reason = await ai_admit(user_id, counters)
+    if reason:
+        if ROUTER_DEBUG:
+            print("AI REJECTED:", {"user": user_id, "reason": reason})
+        return False, None
+
+    started = time.perf_counter()
+    try:
+        return True, await asyncio.to_thread(ai_detect_intent, text, tenant)
+    finally:
+        ai_release((time.perf_counter() - started) * 1000)
+
+
+# ==================================================
+# AI SHADOW (BACKGROUND EVALUATION)
+# Пользователь получает ответ правил сразу,
+# AI гоняем в фоне на выборке и сравниваем результат.
+# Лимиты свои, ai_test_calls не трогаем.
+# ==================================================
+
+SHADOW_QUEUE = None  # asyncio.Queue, создается в start_shadow_workers
+SHADOW_TASKS = []
+SHADOW_STATS = {}  # (sheet_id, rule_key, ai_key) -> int
+SHADOW_PENDING = 0
+
+
+def shadow_should_sample(text_norm: str) -> bool:
+    if ai_mode() != "shadow" or SHADOW_QUEUE is None:
+        return False
+    if is_garbage(text_norm):
+        return False
+    return random.random() < AI_SHADOW_SAMPLE_RATE
+
+
+def shadow_budget():
+    # дневной лимит shadow-вызовов, списывается губернатором при допуске
+    limit = AI_SHADOW_MAX_CALLS_PER_DAY if AI_SHADOW_MAX_CALLS_PER_DAY > 0 else None
+    return [("shadow_calls", datetime.utcnow().date().isoformat(), limit)]
+
+
+def shadow_submit(raw_text: str, rule_key: str, tenant=None):
+    # не блокирует ответ: если очередь полная, просто пропускаем
+    if not shadow_should_sample(normalize_text(raw_text)):
+        return
+
+    try:
+        SHADOW_QUEUE.put_nowait((raw_text, rule_key, tenant or default_tenant()))
+    except asyncio.QueueFull:
+        if ROUTER_DEBUG:
+            print("AI SHADOW QUEUE FULL, skip")
+
+
+def shadow_record(rule_key: str, ai_key: str | None, sheet_id: str | None = None):
+    global SHADOW_PENDING
+
+    ai_key = ai_key or "UNKNOWN"
+    pair = (sheet_id or GOOGLE_SHEET_ID, rule_key, ai_key)
+    SHADOW_STATS[pair] = SHADOW_STATS.get(pair, 0) + 1
+    SHADOW_PENDING += 1
+
+    if ROUTER_DEBUG:
+        print("AI SHADOW:", {"rule": rule_key, "ai": ai_key, "agree": rule_key == ai_key})
+
+
+def flush_shadow_stats():
+    # агрегаты за период: одна строка на пару (rule_key, ai_key),
+    # каждому тенанту в его таблицу
+    global SHADOW_PENDING
+
+    sheets = get_sheets()
+    if not sheets or not SHADOW_STATS:
+        return
+
+    timestamp = datetime.utcnow().isoformat(timespec="seconds")
+    by_sheet = {}
+    for (sheet_id, rule_key, ai_key), count in SHADOW_STATS.items():
+        by_sheet.setdefault(sheet_id, []).append(
+            [timestamp, rule_key, ai_key, "1" if rule_key == ai_key else "0", count]
+        )
+    SHADOW_STATS.clear()
+    SHADOW_PENDING = 0
+
+    for sheet_id, rows in by_sheet.items():
+        if not sheet_id:
+            continue
+        try:
+            sheets.values().append(
+                spreadsheetId=sheet_id,
+                range="shadow!A:E",
+                valueInputOption="RAW",
+                body={"values": rows},
+            ).execute()
+
+        except Exception as e:
+            print(f"Shadow log failed: {e}")
+
+
+async def shadow_worker():
+    while True:
+        raw_text, rule_key, tenant = await SHADOW_QUEUE.get()
+        try:
+            # общий губернатор, но без per-user лимита
+            admitted, ai_key = await governed_ai_detect_intent(
+                raw_text, tenant=tenant, counters=shadow_budget(),
+            )
+            if not admitted:
+                continue
+            shadow_record(rule_key, ai_key, tenant["sheet_id"])
+
+            if SHADOW_PENDING >= AI_SHADOW_FLUSH_EVERY:
+                await asyncio.to_thread(flush_shadow_stats)
+
+        except Exception as e:
+            print(f"AI shadow error: {e}")
+
+        finally:
+            SHADOW_QUEUE.task_done()
+
+
+async def start_shadow_workers(app):
+    global SHADOW_QUEUE
+
+    if ai_mode() != "shadow" or SHADOW_QUEUE is not None:
+        return
+
+    # post_init выполняется до старта app, поэтому app.create_task не подходит:
+    # держим свои хендлы и сами гасим их в stop_shadow_workers
+    SHADOW_QUEUE = asyncio.Queue(maxsize=AI_SHADOW_QUEUE_SIZE)
+    for _ in range(max(1, AI_SHADOW_CONCURRENCY)):
+        SHADOW_TASKS.append(asyncio.create_task(shadow_worker()))
+
+    print(f"AI shadow workers started: {AI_SHADOW_CONCURRENCY}")
+
+
+async def stop_shadow_workers(app):
+    global SHADOW_QUEUE
+
+    if SHADOW_QUEUE is None:
+        return
+
+    # даем доработать то, что уже в очереди, потом гасим воркеров
+    try:
+        await asyncio.wait_for(SHADOW_QUEUE.join(), timeout=AI_SHADOW_DRAIN_SECONDS)
+    except asyncio.TimeoutError:
+        print(f"AI shadow drain timeout, dropped: {SHADOW_QUEUE.qsize()}")
+
+    for task in SHADOW_TASKS:
+        task.cancel()
+    await asyncio.gather(*SHADOW_TASKS, return_exceptions=True)
+    SHADOW_TASKS.clear()
+    SHADOW_QUEUE = None
+
+    await asyncio.to_thread(flush_shadow_stats)
+
+
 # ==================================================
 # AGENTS
 # ==================================================
 
-async def pdd_agent(update, context):
+async def pdd_agent(update, context, tenant=None):
+    await update.message.reply_text(
+        get_response("PDD_ACK", "ПДД: вопрос принят.", tenant)
+    )
+
+async def project_agent(update, context, project: str, tenant=None):
+    # проекты других тенантов: ответ из responses по ключу <PROJECT>_ACK
     await update.message.reply_text(
-        get_response("PDD_ACK", "ПДД: вопрос принят.")
+        get_response(f"{project}_ACK", f"{project}: вопрос принят.", tenant)
     )
 
 def looks_like_question(text: str) -> bool:
     return any(k in text for k in ["как", "что", "где", "когда", "почему", "можно"])
 
-async def unknown_agent(update, context, raw_text: str):
+async def unknown_agent(update, context, raw_text: str, tenant=None):
     user = update.effective_user
     if not user:
         return
 
+    tenant = tenant or default_tenant()
+
     mode = ai_mode()
     text_norm = normalize_text(raw_text)
 
     # 1) мусор - сразу fallback, без AI
     if is_garbage(text_norm):
-        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста."))
+        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.", tenant))
         return
 
     # 2) не похоже на вопрос - тоже без AI
     if not looks_like_question(text_norm):
-        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста."))
+        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.", tenant))
         return
 
     # 3) кеш: в тест-режиме можно полностью игнорировать
-    key = (user.id, cache_key_soft(raw_text))
-
-    if not AI_TEST_NO_CACHE:
-        if key in UNKNOWN_CACHE:
-            if ROUTER_DEBUG:
-                print("UNKNOWN CACHE HIT:", key)
-            await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста."))
-            return
-
     # добавляем в кеш один раз, только после прохождения фильтров
-    UNKNOWN_CACHE.add(key)
+    key = f"{tenant['id']}:{user.id}:{cache_key_soft(raw_text)}"
+    is_new = await state_call("cache_add", "unknown", key, default=True)
 
-    # 4) если AI выключен, сразу fallback
-    if mode == "off":
-        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста."))
+    if not AI_TEST_NO_CACHE and not is_new:
+        if ROUTER_DEBUG:
+            print("UNKNOWN CACHE HIT:", key)
+        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.", tenant))
+        return
+
+    # 4) если AI выключен (или работает только в фоне), сразу fallback
+    if mode in ("off", "shadow"):
+        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.", tenant))
         return
 
     # 5) тестовый лимит вызовов AI на юзера (защита баланса)
     if AI_TEST_MAX_CALLS_PER_USER > 0:
-        calls = AI_TEST_CALLS.get(user.id, 0)
+        calls = await state_call("counter_get", "ai_test_calls", user.id, default=0)
         if calls >= AI_TEST_MAX_CALLS_PER_USER:
-            await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста."))
+            await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.", tenant))
             return
 
     # 6) вызываем AI ровно один раз
     if len(raw_text.strip()) <= 10:
-        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста."))
+        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.", tenant))
         return
 
-    AI_TEST_CALLS[user.id] = AI_TEST_CALLS.get(user.id, 0) + 1
-
-    ai_key = ai_detect_intent(raw_text)
+    # губернатор: rate limits, дневной бюджет, адаптивная параллельность;
+    # тестовый лимит списывается атомарно вместе с допуском
+    limit = AI_TEST_MAX_CALLS_PER_USER if AI_TEST_MAX_CALLS_PER_USER > 0 else None
+    admitted, ai_key = await governed_ai_detect_intent(
+        raw_text, user.id, tenant, counters=[("ai_test_calls", user.id, limit)],
+    )
+    if not admitted:
+        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.", tenant))
+        return
 
     # логируем факт вызова
     if ROUTER_DEBUG:
@@ -725,26 +1505,136 @@ async def unknown_agent(update, context, raw_text: str):
 
     # 7) DRY RUN: AI вызвали, но пользователю не показываем результат
     if mode == "dry_run":
-        log_message(update, "AI_DRY_RUN")
-        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста."))
+        log_message(update, "AI_DRY_RUN", tenant)
+        await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.", tenant))
         return
 
-    # 8) live: если AI вернул ключ из RESPONSES, отвечаем по нему
-    if ai_key and ai_key in RESPONSES:
-        await update.message.reply_text(get_response(ai_key, get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.")))
-        log_message(update, f"AI_INTENT:{ai_key}")
+    # 8) live: если AI вернул ключ из responses тенанта, отвечаем по нему
+    if ai_key and ai_key in tenant["responses"]:
+        await update.message.reply_text(get_response(ai_key, get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.", tenant), tenant))
+        log_message(update, f"AI_INTENT:{ai_key}", tenant)
         return
 
     # 9) иначе fallback
-    await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста."))
+    await update.message.reply_text(get_response("UNKNOWN", "Я не до конца понял вопрос. Уточните, пожалуйста.", tenant))
+
+
+# ==================================================
+# PROFILER (OPT-IN)
+# PROFILE_SAMPLE_RATE - доля вызовов on_message под cProfile,
+# /profile <сек> - профилируем все вызовы в течение окна и пишем
+# один сводный файл, когда окно закроется.
+# Результат: PROFILE_DIR/*.pstats (snakeviz / flameprof / gprof2dot).
+# Выключенный профайлер = одна проверка на сообщение.
+# ==================================================
+
+PROFILE_STATE = {"until": 0.0, "active": False, "seq": 0, "window": None, "task": None}
+
+
+def profile_should_run() -> str | None:
+    # -> "window" (вызов в окне /profile), "sample" или None
+    if PROFILE_STATE["active"]:
+        # cProfile один на поток, вложенные/параллельные вызовы пропускаем
+        return None
+    if time.monotonic() < PROFILE_STATE["until"]:
+        return "window"
+    if random.random() < PROFILE_SAMPLE_RATE:
+        return "sample"
+    return None
+
+
+def profiled(handler):
+    async def wrapper(update, context):
+        if not PROFILE_SAMPLE_RATE and not PROFILE_STATE["until"]:
+            return await handler(update, context)
+
+        mode = profile_should_run()
+        if not mode:
+            return await handler(update, context)
+
+        import cProfile
+
+        # ВАЖНО: профиль async-хендлера включает и другие корутины,
+        # которые event loop выполнял, пока мы ждали await
+        profiler = cProfile.Profile()
+        PROFILE_STATE["active"] = True
+        profiler.enable()
+        try:
+            return await handler(update, context)
+        finally:
+            profiler.disable()
+            PROFILE_STATE["active"] = False
+            if mode == "window":
+                profile_collect(profiler)
+            else:
+                await asyncio.to_thread(profile_dump, profiler, handler.__name__)
+
+    wrapper.__name__ = handler.__name__
+    return wrapper
+
+
+def profile_collect(profiler):
+    # вызовы окна копим в одном pstats.Stats, на диск - один раз в конце
+    import pstats
+
+    if PROFILE_STATE["window"] is None:
+        PROFILE_STATE["window"] = pstats.Stats(profiler)
+    else:
+        PROFILE_STATE["window"].add(profiler)
+
+
+def profile_dump(stats, name: str):
+    # stats - cProfile.Profile или pstats.Stats, у обоих есть dump_stats
+    PROFILE_STATE["seq"] += 1
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    path = PROFILE_DIR / f"{name}-{stamp}-{PROFILE_STATE['seq']}.pstats"
+
+    try:
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        stats.dump_stats(path)
+    except Exception as e:
+        print(f"Profile dump failed: {e}")
+
+
+def profile_start_window(seconds: float):
+    # повторный /profile только сдвигает конец текущего окна
+    PROFILE_STATE["until"] = time.monotonic() + seconds
+    task = PROFILE_STATE["task"]
+    if task is None or task.done():
+        PROFILE_STATE["task"] = asyncio.create_task(profile_window())
+
+
+async def profile_window():
+    while (left := PROFILE_STATE["until"] - time.monotonic()) > 0:
+        await asyncio.sleep(left)
+    await profile_close_window()
+
+
+async def profile_close_window():
+    PROFILE_STATE["until"] = 0.0
+    stats, PROFILE_STATE["window"] = PROFILE_STATE["window"], None
+    if stats is not None:
+        await asyncio.to_thread(profile_dump, stats, "window")
+
+
+async def stop_profile_window():
+    # на остановке бота сохраняем то, что окно успело собрать
+    task = PROFILE_STATE["task"]
+    if task and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    PROFILE_STATE["task"] = None
+    await profile_close_window()
 
 
 # ==================================================
 # DISPATCHER
 # ==================================================
 
+@profiled
 async def on_message(update, context):
-    log_user(update)
+    tenant = await tenant_for(context)
+    log_user(update, tenant)
 
     # исходный текст пользователя (ВАЖНО для AI)
     raw_text = update.message.text or ""
@@ -754,26 +1644,28 @@ async def on_message(update, context):
     # ==================================================
     # 1) FAQ / INTENTS (раньше роутера и AI)
     # ==================================================
-    intent_key = detect_intent(raw_text)
+    intent_key = detect_intent(raw_text, tenant)
     if intent_key:
-        reply_text = get_response(intent_key, "")
+        reply_text = get_response(intent_key, "", tenant)
         if not reply_text or not reply_text.strip():
             reply_text = get_response(
                 "UNKNOWN",
-                "Я не до конца понял вопрос. Уточните, пожалуйста."
+                "Я не до конца понял вопрос. Уточните, пожалуйста.",
+                tenant,
             )
 
         await update.message.reply_text(reply_text)
-        log_message(update, f"INTENT:{intent_key}")
+        log_message(update, f"INTENT:{intent_key}", tenant)
+        shadow_submit(raw_text, intent_key, tenant)
         return
 
     # ==================================================
     # 2) PROJECT ROUTER (PDD / UNKNOWN)
     # ==================================================
-    scores, matches = score_projects(text)
-    project = detect_project(text)
+    scores, matches = score_projects(text, tenant)
+    project = detect_project(text, tenant)
 
-    log_message(update, project)
+    log_message(update, project, tenant)
 
     if ROUTER_DEBUG:
         print("ROUTER DEBUG")
@@ -781,42 +1673,166 @@ async def on_message(update, context):
         print("normalized:", repr(text))
         print("scores:", scores)
         print("matches:", matches)
+        print("tenant:", tenant["id"])
         print("chosen:", project)
         print("-" * 50)
 
+    # с AI сравниваем только UNKNOWN: проект роутера (PDD и т.п.)
+    # не интент, совпасть с ключом AI он не может
+    if project == "UNKNOWN":
+        shadow_submit(raw_text, project, tenant)
+
     # ==================================================
     # 3) AGENTS
     # ==================================================
     if project == "PDD":
-        await pdd_agent(update, context)
+        await pdd_agent(update, context, tenant)
         return
 
     # UNKNOWN — последний шанс (внутри: фильтры + AI)
     if project == "UNKNOWN":
-        await unknown_agent(update, context, raw_text)
+        await unknown_agent(update, context, raw_text, tenant)
         return
 
+    await project_agent(update, context, project, tenant)
+
 # ==================================================
 # COMMANDS
 # ==================================================
 
 async def start(update, context):
-    log_user(update)
+    tenant = await tenant_for(context)
+    log_user(update, tenant)
     await update.message.reply_text(
-        get_response("GREETING", "Привет.")
+        get_response("GREETING", "Привет.", tenant)
     )
 
+def profile_seconds(update, context) -> int | None:
+    # /profile <сек> - только для ADMIN_IDS; None - команду игнорируем
+    user = update.effective_user
+    if not user or user.id not in ADMIN_IDS:
+        return None
+
+    try:
+        seconds = int(context.args[0]) if context.args else 60
+    except ValueError:
+        seconds = 60
+    return max(1, min(seconds, 600))
+
+
+async def profile_command(update, context):
+    seconds = profile_seconds(update, context)
+    if seconds is None:
+        return
+
+    profile_start_window(seconds)
+    await update.message.reply_text(f"Profiling on_message for {seconds}s -> {PROFILE_DIR}")
+
 # ==================================================
 # ENTRY POINT
 # ==================================================
 
+def warm_ai_client():
+    api_key = os.getenv("OPENAI_API_KEY")
+    if ai_mode() != "off" and api_key:
+        get_openai_client(api_key)
+
+
+async def on_startup(app):
+    # Sheets (discovery + batchGet) и импорт openai грузим параллельно,
+    # вне event loop
+    started = time.perf_counter()
+    await asyncio.gather(
+        asyncio.to_thread(init_data),
+        asyncio.to_thread(warm_ai_client),
+    )
+    print(f"Startup data loaded in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    await start_shadow_workers(app)
+
+
+async def on_shutdown(app):
+    await stop_shadow_workers(app)
+    await stop_profile_window()
+    log_ai_stats()
+
+
+def build_app(token: str, tenant_id: str | None = None):
+    from telegram.ext import (
+        Application,
+        CommandHandler,
+        MessageHandler,
+        filters,
+    )
+
+    app = (
+        Application.builder()
+        .token(token)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    if tenant_id:
+        app.bot_data["tenant_id"] = tenant_id
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_message))
+    return app
+
+
+async def run_tenant_bots():
+    # несколько ботов в одном event loop: свой Application на тенанта,
+    # индексы тенантов общие (LRU)
+    apps = [
+        build_app(config["bot_token"], tenant_id)
+        for tenant_id, config in TENANTS.items()
+        if config.get("bot_token")
+    ]
+    if not apps:
+        raise RuntimeError("TENANTS_CONFIG has no bot_token entries")
+
+    for app in apps:
+        await app.initialize()
+    await on_startup(apps[0])
+
+    for app in apps:
+        await app.start()
+        await app.updater.start_polling()
+
+    print(f"Bot is running for tenants: {[a.bot_data['tenant_id'] for a in apps]}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for app in apps:
+            await app.updater.stop()
+            await app.stop()
+        await on_shutdown(None)
+        for app in apps:
+            await app.shutdown()
+
+
 def main():
+    load_tenants_config()
+
+    if TENANTS:
+        try:
+            asyncio.run(run_tenant_bots())
+        except KeyboardInterrupt:
+            pass
+        return
+
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN not found in .env")
 
-    app = Application.builder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_message))
+    if BOT_WORKERS > 1:
+        import sharded
+
+        sharded.run(BOT_WORKERS)
+        return
+
+    app = build_app(BOT_TOKEN)
 
     print("Bot is running...")
     app.run_polling()
@@ -0,0 +1,358 @@
+# ==================================================
+# ROUTING EVAL (INTENTS + ROUTER)
+# ==================================================
+#
+# Прогоняет размеченный корпус через detect_intent -> detect_project
+# и сравнивает точность / скорость с сохраненным baseline.
+#
+#   python routing_eval.py                    # отчет + проверка baseline
+#   python routing_eval.py --update-baseline  # перезаписать baseline
+#
+# Exit code 1, если упала точность (общая или recall любой метки),
+# появились новые перекрытые паттерны или выросло число проверок
+# паттернов на сообщение. Латентность сравниваем
+# в единицах калибровочного цикла того же прогона (не зависит от машины);
+# абсолютные микросекунды - только предупреждение, если нет --strict-latency.
+
+import argparse
+import json
+import re
+import sys
+import time
+from pathlib import Path
+
+import main
+
+EVAL_DIR = Path(__file__).resolve().parent / "eval"
+CORPUS_PATH = EVAL_DIR / "routing_corpus.jsonl"
+ROUTER_KEYWORDS_PATH = EVAL_DIR / "router_keywords.json"
+BASELINE_PATH = EVAL_DIR / "routing_baseline.json"
+
+# латентность меряем на машине запуска, поэтому допуск широкий
+LATENCY_TOLERANCE = 0.5
+TIMING_REPEATS = 200
+CALIBRATION_RUNS = 3
+CALIBRATION_TEXT = "как проходит экзамен по пдд на русском языке, сколько стоит?"
+
+
+# ==================================================
+# LOAD
+# ==================================================
+
+def load_corpus(path: Path = CORPUS_PATH):
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rows.append(json.loads(line))
+    return rows
+
+
+def load_router_keywords(path: Path = ROUTER_KEYWORDS_PATH):
+    # при импорте main данные из Sheets не грузятся (init_data на старте бота),
+    # поэтому по умолчанию берем локальный снапшот contexts!A:B
+    if main.ROUTER_KEYWORDS:
+        return main.ROUTER_KEYWORDS
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ==================================================
+# ROUTE (тот же порядок, что в on_message)
+# ==================================================
+
+def route(raw_text: str) -> tuple[str, str]:
+    intent_key = main.detect_intent(raw_text)
+    if intent_key:
+        return intent_key, "intent"
+    return main.detect_project(main.normalize_text(raw_text)), "router"
+
+
+def time_route(raw_text: str, repeats: int = TIMING_REPEATS, runs: int = 3) -> float:
+    # микросекунды на одно сообщение, лучший из runs прогонов (меньше шума)
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            route(raw_text)
+        elapsed = (time.perf_counter() - start) / repeats * 1_000_000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibration_us(runs: int = CALIBRATION_RUNS) -> float:
+    # эталонная нагрузка того же типа (regex + поиск подстрок), лучший из N
+    # прогонов; меряем рядом с каждым сообщением и делим на нее, чтобы
+    # сравнивать между машинами и гасить дрейф частоты CPU
+    words = CALIBRATION_TEXT.split() * 4
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        for _ in range(TIMING_REPEATS):
+            t = re.sub(r"[^\w\s/]", "", CALIBRATION_TEXT.lower())
+            for w in words:
+                w in t
+        elapsed = (time.perf_counter() - start) / TIMING_REPEATS * 1_000_000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def scan_cost(raw_text: str) -> int:
+    # сколько паттернов/ключевых слов проверено до ответа: детерминировано,
+    # растет, когда паттерны добавляют в начало или удлиняют списки.
+    # Проверки интентов считает сам match_intent; роутер (score_projects)
+    # всегда проходит все ключевые слова тенанта
+    key, probes = main.match_intent(raw_text)
+    if key or not probes:
+        return probes
+    return probes + sum(len(kws) for kws in main.default_tenant()["router_keywords"].values())
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[idx]
+
+
+# ==================================================
+# METRICS
+# ==================================================
+
+def confusion(pairs):
+    # expected -> predicted -> count
+    matrix = {}
+    for expected, predicted in pairs:
+        row = matrix.setdefault(expected, {})
+        row[predicted] = row.get(predicted, 0) + 1
+    return matrix
+
+
+def precision_recall(pairs):
+    labels = sorted({e for e, _ in pairs} | {p for _, p in pairs})
+    stats = {}
+    for label in labels:
+        tp = sum(1 for e, p in pairs if e == label and p == label)
+        fp = sum(1 for e, p in pairs if e != label and p == label)
+        fn = sum(1 for e, p in pairs if e == label and p != label)
+        stats[label] = {
+            "precision": tp / (tp + fp) if tp + fp else 0.0,
+            "recall": tp / (tp + fn) if tp + fn else 0.0,
+            "support": tp + fn,
+        }
+    return stats
+
+
+def shadowed_patterns():
+    # паттерн, который сам по себе уходит в другой интент, перекрыт
+    # более ранним ключом; None - паттерн недостижим вообще
+    found = []
+    for key, patterns in main.INTENT_PATTERNS:
+        for p in patterns:
+            got = main.detect_intent(p)
+            if got != key:
+                found.append({"key": key, "pattern": p, "detected": got})
+    return found
+
+
+def evaluate(corpus):
+    pairs = []
+    misses = []
+    timings = []
+    relative = []
+    calibrations = []
+    scans = []
+
+    for row in corpus:
+        text = row["text"]
+        expected = row["label"]
+        predicted, tier = route(text)
+        pairs.append((expected, predicted))
+        calibration = calibration_us()
+        timing = time_route(text)
+        calibrations.append(calibration)
+        timings.append(timing)
+        relative.append(timing / calibration if calibration else 0.0)
+        scans.append(scan_cost(text))
+
+        if predicted != expected:
+            misses.append({
+                "text": text,
+                "expected": expected,
+                "predicted": predicted,
+                "tier": tier,
+            })
+
+    correct = sum(1 for e, p in pairs if e == p)
+    latency_p95 = percentile(timings, 0.95)
+
+    return {
+        "accuracy": correct / len(pairs) if pairs else 0.0,
+        "per_label": precision_recall(pairs),
+        "confusion": confusion(pairs),
+        "misses": misses,
+        "shadowed": shadowed_patterns(),
+        "latency_us": {
+            "p50": percentile(timings, 0.50),
+            "p95": latency_p95,
+            "max": max(timings) if timings else 0.0,
+        },
+        "calibration_us": percentile(calibrations, 0.50),
+        "latency_p95_rel": percentile(relative, 0.95),
+        "scans_per_message": sum(scans) / len(scans) if scans else 0.0,
+    }
+
+
+# ==================================================
+# REPORT
+# ==================================================
+
+def print_report(result):
+    print("ROUTING EVAL")
+    print(f"accuracy: {result['accuracy']:.3f}")
+    print("-" * 50)
+
+    print(f"{'label':<28}{'prec':>7}{'rec':>7}{'n':>5}")
+    for label, s in result["per_label"].items():
+        print(f"{label:<28}{s['precision']:>7.2f}{s['recall']:>7.2f}{s['support']:>5}")
+    print("-" * 50)
+
+    print("confusion (expected -> predicted):")
+    for expected, row in sorted(result["confusion"].items()):
+        cells = ", ".join(f"{p}={n}" for p, n in sorted(row.items()))
+        print(f"  {expected}: {cells}")
+    print("-" * 50)
+
+    if result["misses"]:
+        print("misses:")
+        for m in result["misses"]:
+            print(f"  {m['text']!r}: expected {m['expected']}, got {m['predicted']} ({m['tier']})")
+        print("-" * 50)
+
+    print(f"shadowed / unreachable patterns: {len(result['shadowed'])}")
+    for s in result["shadowed"]:
+        print(f"  {s['key']}: {s['pattern']!r} -> {s['detected']}")
+    print("-" * 50)
+
+    lat = result["latency_us"]
+    print(f"latency per message, us: p50={lat['p50']:.1f} p95={lat['p95']:.1f} max={lat['max']:.1f}")
+    print(f"calibration loop, us: {result['calibration_us']:.1f} (p95 = {result['latency_p95_rel']:.2f}x)")
+    print(f"pattern checks per message: {result['scans_per_message']:.1f}")
+
+
+# ==================================================
+# BASELINE
+# ==================================================
+
+def shadowed_id(s) -> str:
+    return f"{s['key']}: {s['pattern']} -> {s['detected']}"
+
+
+def baseline_snapshot(result):
+    return {
+        "accuracy": round(result["accuracy"], 4),
+        "recall": {label: round(s["recall"], 4) for label, s in result["per_label"].items()},
+        "shadowed": len(result["shadowed"]),
+        "shadowed_patterns": [shadowed_id(s) for s in result["shadowed"]],
+        "latency_us": {k: round(v, 1) for k, v in result["latency_us"].items()},
+        "latency_p95_rel": round(result["latency_p95_rel"], 3),
+        "scans_per_message": round(result["scans_per_message"], 2),
+    }
+
+
+def check_baseline(result, baseline, tolerance: float = LATENCY_TOLERANCE, strict_latency: bool = False):
+    # -> (problems, warnings)
+    problems = []
+    warnings = []
+
+    if round(result["accuracy"], 4) < baseline["accuracy"]:
+        problems.append(
+            f"accuracy dropped: {result['accuracy']:.4f} < {baseline['accuracy']:.4f}"
+        )
+
+    # по меткам: просадку одного интента не должен маскировать рост другого
+    for label, recall in baseline.get("recall", {}).items():
+        s = result["per_label"].get(label)
+        got = round(s["recall"], 4) if s else 0.0
+        if got < recall:
+            problems.append(f"recall dropped for {label}: {got:.4f} < {recall:.4f}")
+
+    if len(result["shadowed"]) > baseline["shadowed"]:
+        problems.append(
+            f"more shadowed patterns: {len(result['shadowed'])} > {baseline['shadowed']}"
+        )
+
+    # замена одного перекрытого паттерна другим тоже регрессия
+    if "shadowed_patterns" in baseline:
+        known = set(baseline["shadowed_patterns"])
+        for s in result["shadowed"]:
+            if shadowed_id(s) not in known:
+                problems.append(f"new shadowed pattern: {shadowed_id(s)}")
+
+    if "scans_per_message" in baseline and round(result["scans_per_message"], 2) > baseline["scans_per_message"]:
+        problems.append(
+            f"pattern checks per message grew: {result['scans_per_message']:.2f} > {baseline['scans_per_message']:.2f}"
+        )
+
+    if "latency_p95_rel" in baseline:
+        limit = baseline["latency_p95_rel"] * (1 + tolerance)
+        if result["latency_p95_rel"] > limit:
+            problems.append(
+                f"relative p95 latency grew: {result['latency_p95_rel']:.2f}x > {limit:.2f}x"
+            )
+
+    # абсолютные микросекунды зависят от машины
+    limit = baseline["latency_us"]["p95"] * (1 + tolerance)
+    if result["latency_us"]["p95"] > limit:
+        message = f"p95 latency grew: {result['latency_us']['p95']:.1f}us > {limit:.1f}us"
+        (problems if strict_latency else warnings).append(message)
+
+    return problems, warnings
+
+
+# ==================================================
+# ENTRY POINT
+# ==================================================
+
+def run(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Routing accuracy and speed regression check")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=LATENCY_TOLERANCE)
+    parser.add_argument("--strict-latency", action="store_true", help="fail on absolute us p95 too")
+    args = parser.parse_args(argv)
+
+    main.ROUTER_KEYWORDS = load_router_keywords()
+
+    result = evaluate(load_corpus())
+    print_report(result)
+    print("-" * 50)
+
+    if args.update_baseline or not BASELINE_PATH.exists():
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(baseline_snapshot(result), f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"Baseline written: {BASELINE_PATH}")
+        return 0
+
+    with open(BASELINE_PATH, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    problems, warnings = check_baseline(result, baseline, args.tolerance, args.strict_latency)
+    for w in warnings:
+        print("WARNING:", w)
+
+    if problems:
+        print("REGRESSION")
+        for p in problems:
+            print(" ", p)
+        return 1
+
+    print("OK: no regression against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,201 @@
+# ==================================================
+# SHARDED DEPLOYMENT (BOT_WORKERS > 1)
+# ==================================================
+#
+# front-процесс: long polling + раскладка апдейтов по воркерам
+#                по chat_id % N (порядок внутри чата сохраняется)
+# воркеры:       свой event loop, свой Bot для ответов,
+#                routing snapshot только на чтение,
+#                общий SQLite (STATE_DIR/state.db) для счетчиков и кешей
+# /profile front рассылает всем воркерам: окно профилирования
+# открывается в каждом процессе, отвечает только воркер чата
+#
+# Запуск: BOT_WORKERS=4 python main.py
+
+import asyncio
+import multiprocessing as mp
+from types import SimpleNamespace
+
+import main
+
+SNAPSHOT_PATH = main.STATE_DIR / "routing_snapshot.json"
+STATE_DB_PATH = main.STATE_DIR / "state.db"
+
+
+# ==================================================
+# WORKER
+# ==================================================
+
+def parse_command(text: str | None):
+    # -> (command, args) или (None, []) для обычного текста
+    if not text or not text.startswith("/"):
+        return None, []
+    parts = text.split()
+    return parts[0][1:].split("@")[0].lower(), parts[1:]
+
+
+async def dispatch(update, bot):
+    # те же хендлеры, что в main(): /start, /profile и текст без команд
+    message = update.message
+    if not message or not message.text:
+        return
+
+    command, args = parse_command(message.text)
+    if command:
+        context = SimpleNamespace(bot=bot, args=args)
+
+        if command == "start":
+            await main.start(update, context)
+        elif command == "profile":
+            await main.profile_command(update, context)
+        return
+
+    await main.on_message(update, SimpleNamespace(bot=bot, args=[]))
+
+
+async def worker_loop(index: int, queue, workers: int):
+    from telegram import Bot, Update
+
+    bot = Bot(main.BOT_TOKEN)
+    await bot.initialize()
+
+    # in-flight лимит AI делим между воркерами, rate/spend лимиты общие в SQLite
+    main.AI_MAX_IN_FLIGHT = max(1, main.AI_MAX_IN_FLIGHT // workers)
+    main.AI_GOVERNOR["limit"] = main.AI_MAX_IN_FLIGHT
+
+    # Sheets discovery и openai - в потоке до первого сообщения, как в on_startup
+    await asyncio.gather(
+        asyncio.to_thread(main.get_sheets),
+        asyncio.to_thread(main.warm_ai_client),
+    )
+    await main.start_shadow_workers(None)
+
+    print(f"Worker {index} ready")
+
+    try:
+        while True:
+            data = await asyncio.to_thread(queue.get)
+            if data is None:
+                break
+
+            try:
+                if "profile_broadcast" in data:
+                    # /profile из чужого шарда: открываем окно без ответа
+                    update = Update.de_json(data["profile_broadcast"], bot)
+                    _, args = parse_command(update.message.text)
+                    seconds = main.profile_seconds(update, SimpleNamespace(args=args))
+                    if seconds:
+                        main.profile_start_window(seconds)
+                    continue
+
+                await dispatch(Update.de_json(data, bot), bot)
+            except Exception as e:
+                print(f"Worker {index} update failed: {e}")
+
+    finally:
+        await main.on_shutdown(None)
+        await bot.shutdown()
+
+
+def worker_main(index: int, queue, workers: int):
+    main.STATE = main.open_state(STATE_DB_PATH)
+    main.load_routing_snapshot(SNAPSHOT_PATH)
+
+    try:
+        asyncio.run(worker_loop(index, queue, workers))
+    except KeyboardInterrupt:
+        pass
+
+
+# ==================================================
+# FRONT
+# ==================================================
+
+def shard_for(update, workers: int) -> int:
+    chat = update.effective_chat
+    return (chat.id if chat else 0) % workers
+
+
+def start_worker(ctx, index: int, queue, workers: int):
+    proc = ctx.Process(target=worker_main, args=(index, queue, workers), daemon=True)
+    proc.start()
+    return proc
+
+
+def check_workers(ctx, procs, queues):
+    # оффсет поллинга уже сдвинут, поэтому мертвый воркер = потерянные
+    # апдейты его шарда; поднимаем заново на той же очереди
+    for i, proc in enumerate(procs):
+        if proc.is_alive():
+            continue
+        print(f"Worker {i} died (exit code {proc.exitcode}), restarting; "
+              f"update in progress may be lost, queued: {queues[i].qsize()}")
+        procs[i] = start_worker(ctx, i, queues[i], len(procs))
+
+
+async def front_loop(ctx, procs, queues):
+    from telegram import Bot
+
+    bot = Bot(main.BOT_TOKEN)
+    await bot.initialize()
+    await bot.delete_webhook()
+
+    offset = None
+    try:
+        while True:
+            check_workers(ctx, procs, queues)
+
+            try:
+                updates = await bot.get_updates(
+                    offset=offset,
+                    timeout=30,
+                    allowed_updates=["message"],
+                )
+            except Exception as e:
+                print(f"Polling failed: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                shard = shard_for(update, len(queues))
+                data = update.to_dict()
+                queues[shard].put(data)
+
+                # профиль нужен со всех воркеров, а не только с шарда админа
+                message = update.message
+                if parse_command(message.text if message else None)[0] == "profile":
+                    for i, q in enumerate(queues):
+                        if i != shard:
+                            q.put({"profile_broadcast": data})
+
+    finally:
+        await bot.shutdown()
+
+
+def run(workers: int):
+    # данные из Sheets грузим один раз и отдаем воркерам снапшотом
+    main.init_data()
+    main.save_routing_snapshot(SNAPSHOT_PATH)
+
+    # общий стор создаем до старта воркеров (WAL + таблицы) и чистим:
+    # после рестарта лимиты и кеши такие же, как у ":memory:" в одном процессе,
+    # кроме дневного расхода AI
+    main.open_state(STATE_DB_PATH).reset(keep=main.STATE_KEEP_ON_RESET)
+
+    ctx = mp.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(workers)]
+    procs = [start_worker(ctx, i, queues[i], workers) for i in range(workers)]
+
+    print(f"Bot is running with {workers} workers...")
+
+    try:
+        asyncio.run(front_loop(ctx, procs, queues))
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        for q in queues:
+            q.put(None)
+        for proc in procs:
+            proc.join(timeout=10)
@@ -0,0 +1,204 @@
+# ==================================================
+# SHARED STATE (COUNTERS + CACHES)
+# ==================================================
+#
+# Кеши и счетчики бота в SQLite:
+#   ":memory:"  - один процесс (по умолчанию)
+#   путь к файлу - общий стор для нескольких воркеров (WAL),
+#                  лимиты и кеши остаются корректными между процессами
+#
+# Все операции check-and-update атомарные (BEGIN IMMEDIATE).
+# busy_timeout короткий: при конкуренции за запись лучше быстро получить
+# sqlite3.OperationalError и отработать fallback, чем держать event loop.
+# Старые записи чистятся по TTL (не чаще раза в prune_interval): кеш весь,
+# счетчики - только перечисленные в prune_counters (дневные ключи, бакеты);
+# остальные (например, лимит AI на юзера) живут до reset().
+
+import sqlite3
+import threading
+import time
+
+
+class SharedState:
+    def __init__(
+        self,
+        path: str = ":memory:",
+        busy_timeout: float = 0.25,
+        cache_ttl: float = 86400,
+        counter_ttl: float = 2 * 86400,
+        prune_interval: float = 300,
+        prune_counters=(),
+    ):
+        self.path = str(path)
+        self.cache_ttl = cache_ttl
+        self.counter_ttl = counter_ttl
+        self.prune_interval = prune_interval
+        self.prune_counters = tuple(prune_counters)
+        self.last_prune = time.time()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.path,
+            timeout=busy_timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+
+        if self.path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        self.create_tables()
+
+    def create_tables(self):
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " name TEXT NOT NULL, key TEXT NOT NULL, ts REAL NOT NULL,"
+            " PRIMARY KEY (name, key)) WITHOUT ROWID"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS counters ("
+            " name TEXT NOT NULL, key TEXT NOT NULL,"
+            " value REAL NOT NULL, ts REAL NOT NULL,"
+            " PRIMARY KEY (name, key)) WITHOUT ROWID"
+        )
+
+    def reset(self, keep=()):
+        # чистый стор на старте, как у ":memory:" после рестарта;
+        # счетчики из keep (например, дневной расход AI) сохраняем
+        keep = tuple(keep)
+        with self.lock:
+            self.conn.execute("DROP TABLE IF EXISTS cache")
+            self.create_tables()
+            if keep:
+                marks = ",".join("?" * len(keep))
+                self.conn.execute(f"DELETE FROM counters WHERE name NOT IN ({marks})", keep)
+            else:
+                self.conn.execute("DELETE FROM counters")
+
+    def prune(self, now: float | None = None):
+        # ts у кеша - время добавления, у счетчиков - последней записи;
+        # старые дневные ключи и бакеты забытых юзеров уходят по TTL
+        now = now or time.time()
+        with self.lock:
+            self.conn.execute("DELETE FROM cache WHERE ts < ?", (now - self.cache_ttl,))
+            if self.prune_counters:
+                marks = ",".join("?" * len(self.prune_counters))
+                self.conn.execute(
+                    f"DELETE FROM counters WHERE ts < ? AND name IN ({marks})",
+                    (now - self.counter_ttl, *self.prune_counters),
+                )
+            self.last_prune = now
+
+    def maybe_prune(self):
+        if time.time() - self.last_prune >= self.prune_interval:
+            self.prune()
+
+    # ==================================================
+    # CACHE
+    # ==================================================
+
+    def cache_add(self, name: str, key: str) -> bool:
+        # True - ключ добавлен впервые, False - уже был
+        self.maybe_prune()
+        with self.lock:
+            cur = self.conn.execute(
+                "INSERT OR IGNORE INTO cache (name, key, ts) VALUES (?, ?, ?)",
+                (name, str(key), time.time()),
+            )
+            return cur.rowcount == 1
+
+    # ==================================================
+    # COUNTERS
+    # ==================================================
+
+    def counter_get(self, name: str, key) -> float:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM counters WHERE name = ? AND key = ?",
+                (name, str(key)),
+            ).fetchone()
+            return row[0] if row else 0
+
+    def counter_add(self, name: str, key, delta: float = 1, limit: float | None = None) -> bool:
+        # limit - потолок; если delta его превысит, ничего не меняем и вернем False
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT value FROM counters WHERE name = ? AND key = ?",
+                    (name, str(key)),
+                ).fetchone()
+                value = row[0] if row else 0
+
+                if limit is not None and delta > 0 and value + delta > limit:
+                    self.conn.execute("ROLLBACK")
+                    return False
+
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO counters (name, key, value, ts) VALUES (?, ?, ?, ?)",
+                    (name, str(key), value + delta, time.time()),
+                )
+                self.conn.execute("COMMIT")
+                return True
+
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    # ==================================================
+    # TOKEN BUCKETS + BUDGETS (ALL OR NOTHING)
+    # ==================================================
+
+    def bucket_take(self, name: str, key, rate_per_min: float, burst: float) -> bool:
+        return self.charge_all([(name, key, rate_per_min, burst)]) is None
+
+    def charge_all(self, buckets=(), counters=()) -> str | None:
+        # buckets:  (name, key, rate_per_min, burst) - списать 1 токен
+        # counters: (name, key, limit) - прибавить 1, если не выйдем за limit
+        # Списываем либо все сразу, либо ничего. None - ок, иначе "name:key"
+        # первого отказавшего. Для бакетов value - остаток токенов,
+        # ts - время последнего пополнения (wall clock, одинаково во всех процессах)
+        self.maybe_prune()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                writes = []
+
+                for name, key, rate_per_min, burst in buckets:
+                    row = self.conn.execute(
+                        "SELECT value, ts FROM counters WHERE name = ? AND key = ?",
+                        (name, str(key)),
+                    ).fetchone()
+
+                    tokens = burst
+                    if row:
+                        tokens = min(burst, row[0] + max(0.0, now - row[1]) * rate_per_min / 60)
+
+                    if tokens < 1:
+                        self.conn.execute("ROLLBACK")
+                        return f"{name}:{key}"
+                    writes.append((name, str(key), tokens - 1, now))
+
+                for name, key, limit in counters:
+                    row = self.conn.execute(
+                        "SELECT value FROM counters WHERE name = ? AND key = ?",
+                        (name, str(key)),
+                    ).fetchone()
+                    value = row[0] if row else 0
+
+                    if limit is not None and value + 1 > limit:
+                        self.conn.execute("ROLLBACK")
+                        return f"{name}:{key}"
+                    writes.append((name, str(key), value + 1, now))
+
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO counters (name, key, value, ts) VALUES (?, ?, ?, ?)",
+                    writes,
+                )
+                self.conn.execute("COMMIT")
+                return None
+
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
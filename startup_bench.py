@@ -0,0 +1,108 @@
+# ==================================================
+# STARTUP BENCH
+# ==================================================
+#
+# Меряет холодный старт:
+#   - import main в чистом интерпретаторе
+#   - init_data() (Sheets, если настроен в .env)
+#   - первый ответ on_message (от входа до reply_text)
+#
+#   python startup_bench.py            # вывести замеры
+#   python startup_bench.py --record   # дописать в eval/startup_history.jsonl
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent
+HISTORY_PATH = ROOT / "eval" / "startup_history.jsonl"
+
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import main; "
+    "print((time.perf_counter() - t) * 1000)"
+)
+
+
+def measure_import_ms(repeats: int) -> float:
+    # каждый замер в новом процессе, иначе модуль уже в sys.modules
+    runs = []
+    for _ in range(repeats):
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(float(out.strip().splitlines()[-1]))
+    return min(runs)
+
+
+class BenchMessage:
+    # минимальный update.message для прогона on_message без Telegram
+    def __init__(self, text: str):
+        self.text = text
+        self.replied_at = None
+
+    async def reply_text(self, text):
+        if self.replied_at is None:
+            self.replied_at = time.perf_counter()
+
+
+async def measure_first_reply_ms(main, text: str) -> float:
+    message = BenchMessage(text)
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=0, first_name="bench", username="bench"),
+        message=message,
+    )
+
+    started = time.perf_counter()
+    await main.on_message(update, None)
+    return ((message.replied_at or time.perf_counter()) - started) * 1000
+
+
+def run(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Import and first-reply latency")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--text", default="сколько стоит подписка")
+    parser.add_argument("--record", action="store_true")
+    args = parser.parse_args(argv)
+
+    import_ms = measure_import_ms(args.repeats)
+
+    import main
+
+    started = time.perf_counter()
+    main.init_data()
+    init_ms = (time.perf_counter() - started) * 1000
+
+    first_reply_ms = asyncio.run(measure_first_reply_ms(main, args.text))
+
+    result = {
+        "ts": datetime.utcnow().isoformat(timespec="seconds"),
+        "import_ms": round(import_ms, 1),
+        "init_data_ms": round(init_ms, 1),
+        "first_reply_ms": round(first_reply_ms, 1),
+        "sheets": main.get_sheets() is not None,
+    }
+
+    print("STARTUP BENCH")
+    for key, value in result.items():
+        print(f"{key}: {value}")
+
+    if args.record:
+        with open(HISTORY_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+        print(f"Recorded: {HISTORY_PATH}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,147 @@
+# ==================================================
+# TENANTS: LRU + ЗАГРУЗКА / ОБНОВЛЕНИЕ
+# ==================================================
+#
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main
+
+
+def tenant_data(reply: str):
+    return {
+        "router_keywords": {},
+        "responses": {"GREETING": [reply]},
+        "intent_patterns": [["GREETING", ["привет"]]],
+    }
+
+
+class TenantCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = (
+            main.STATE_DIR, main.TENANTS, main.TENANT_CACHE_SIZE,
+            main.fetch_tenant_data, main.get_sheets,
+        )
+        main.STATE_DIR = Path(self.tmp.name)
+        main.TENANTS = {"a": {"sheet_id": "sa"}, "b": {"sheet_id": "sb"}}
+        main.TENANT_INDEXES.clear()
+        main.TENANT_LOADS.clear()
+        main.TENANT_REFRESHES.clear()
+
+    def tearDown(self):
+        (
+            main.STATE_DIR, main.TENANTS, main.TENANT_CACHE_SIZE,
+            main.fetch_tenant_data, main.get_sheets,
+        ) = self.saved
+        main.TENANT_INDEXES.clear()
+        self.tmp.cleanup()
+
+    def write_snapshot(self, tenant_id: str, reply: str, age: float = 0):
+        main.save_tenant_snapshot(tenant_id, tenant_data(reply))
+        path = main.tenant_snapshot_path(tenant_id)
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+
+    async def test_evicted_during_refresh_loads_again(self):
+        # a: устаревший снапшот -> фоновый refresh с медленным Sheets;
+        # пока он идет, a вытесняют из LRU, следующее сообщение для a
+        # должно загрузить индекс, а не ждать refresh (раньше KeyError)
+        main.TENANT_CACHE_SIZE = 1
+        self.write_snapshot("a", "old a", age=10 * main.TENANT_SNAPSHOT_MAX_AGE)
+        self.write_snapshot("b", "b")
+
+        release = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def slow_fetch(config):
+            asyncio.run_coroutine_threadsafe(release.wait(), loop).result()
+            return tenant_data("fresh " + config["sheet_id"])
+
+        main.fetch_tenant_data = slow_fetch
+
+        a = await main.get_tenant("a")
+        self.assertEqual(a["responses"]["GREETING"], ["old a"])
+        self.assertIn("a", main.TENANT_REFRESHES)
+
+        await main.get_tenant("b")
+        self.assertNotIn("a", main.TENANT_INDEXES)
+
+        a = await main.get_tenant("a")
+        self.assertEqual(a["id"], "a")
+        self.assertIn("a", main.TENANT_INDEXES)
+
+        release.set()
+        await asyncio.gather(*main.TENANT_REFRESHES.values())
+        with open(main.tenant_snapshot_path("a"), encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["responses"]["GREETING"], ["fresh sa"])
+
+    async def test_concurrent_cold_loads_share_one_task(self):
+        self.write_snapshot("a", "a")
+        indexes = await asyncio.gather(*[main.get_tenant("a") for _ in range(5)])
+        self.assertTrue(all(index is indexes[0] for index in indexes))
+        self.assertEqual(main.TENANT_LOADS, {})
+
+
+class FetchTenantDataTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = main.get_sheets
+        self.calls = []
+
+        calls = self.calls
+
+        class Request:
+            def __init__(self, result):
+                self.result = result
+
+            def execute(self):
+                if isinstance(self.result, Exception):
+                    raise self.result
+                return self.result
+
+        class Values:
+            def batchGet(self, spreadsheetId, ranges):
+                calls.append(("batchGet", ranges))
+                return Request({"valueRanges": [
+                    {"values": [["project", "keywords"], ["PDD", "пдд"]]},
+                    {"values": [["key", "text"], ["GREETING", "hi"]]},
+                ]})
+
+            def get(self, spreadsheetId, range):
+                calls.append(("get", range))
+                return Request(Exception("Unable to parse range: intents!A:B"))
+
+        class Sheets:
+            def values(self):
+                return Values()
+
+        main.get_sheets = lambda: Sheets()
+
+    def tearDown(self):
+        main.get_sheets = self.saved
+
+    def test_builtin_intents_do_not_request_intents_tab(self):
+        data = main.fetch_tenant_data({"sheet_id": "s", "use_builtin_intents": True})
+        self.assertEqual(self.calls, [("batchGet", ["contexts!A:B", "responses!A:B"])])
+        self.assertTrue(data["responses"])
+
+    def test_missing_intents_tab_keeps_contexts_and_responses(self):
+        data = main.fetch_tenant_data({"sheet_id": "s"})
+        self.assertEqual(self.calls[-1], ("get", "intents!A:B"))
+        self.assertTrue(data["responses"])
+        self.assertEqual(data["intent_patterns"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()